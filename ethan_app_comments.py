@@ -1,26 +1,172 @@
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, stream_with_context, g, has_request_context
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager, create_access_token, set_access_cookies, jwt_required, get_jwt_identity
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+import bcrypt
+from flask_jwt_extended import JWTManager, create_access_token, set_access_cookies, jwt_required, get_jwt_identity, get_jwt
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import raiseload
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+from typing import Optional
 from dotenv import load_dotenv
+import orjson
+import hashlib
+import threading
+from cachetools import TTLCache
 import os
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor as _StdExecutor
+
+# When running under gevent (see gunicorn_gevent.conf.py) the standard threads are replaced by greenlets, which would
+# run the password hashing on the event loop and block every other request. gevent's own executor uses real threads.
+_Executor = _StdExecutor
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as _GeventExecutor
+        _Executor = _GeventExecutor
+except ImportError:
+    pass
 
 load_dotenv()
 
 
+# A JSON provider that uses orjson instead of Python's standard json module for all of the app's JSON.
+# orjson is written in compiled code and is several times faster; every route in this app returns JSON, so they all benefit.
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        # orjson returns bytes, Flask expects a string here
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
 
+# Tell Flask to use the orjson provider (used for `return {...}`, `jsonify()` and `request.json`)
+app.json = OrjsonProvider(app)
+
+# Routing settings: match URLs with or without a trailing slash (instead of redirecting), and treat repeated slashes as one.
+# The routes below are also registered with `provide_automatic_options=False`, so Flask doesn't add an automatic
+# OPTIONS handler to each one (this API doesn't need CORS preflight requests)
+app.url_map.strict_slashes = False
+app.url_map.merge_slashes = True
+
 # Connect to database
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
 
+# Reject request bodies over 1 MB before they're read or parsed (Flask returns 413 Request Entity Too Large).
+# This is a generous app-wide safety cap (product descriptions can be long); the auth routes use the much
+# smaller AUTH_MAX_CONTENT_LENGTH below, see `read_auth_body()`
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+
+# Largest request body accepted by /auth/register and /auth/login (a username, email and password fit easily in 4 KB)
+AUTH_MAX_CONTENT_LENGTH = 4096
+
+# Connection pool settings for the database engine. Keeping connections open and reusing them saves opening a new
+# connection (TCP + auth handshake) on every request.
+# Every gunicorn worker process has its own pool, so its size comes from gunicorn_gevent.conf.py (DB_POOL_SIZE), which
+# splits the postgres connection budget between the workers and lets each worker take only that many requests at once.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)), # Connections kept open
+    'max_overflow': 0, # No extra connections, so all the workers together stay within the budget
+    'pool_pre_ping': True, # Check a connection still works before using it
+    'pool_recycle': 1800, # Replace connections after 30 minutes
+    'pool_use_lifo': True # Reuse the most recently used connection first, so it stays warm
+}
+
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
-bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 
+# Password hasher using Argon2id, which is memory-hard (much harder to crack on GPUs than bcrypt) and hashes faster
+# at the same level of security. Each hash makes 2 passes over 64 MiB of memory on a single thread.
+ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+# Thread pool for password hashing. The hashing libraries release the GIL while they hash, so running the hash calls
+# on these threads lets several registrations/logins hash in parallel on different CPU cores.
+# Every worker process gets its own pool, so gunicorn passes in each worker's share of the cores (HASH_THREADS),
+# otherwise all the workers together could run many more 64 MiB hashes at once than there are cores
+EXEC = _Executor(max_workers=int(os.getenv('HASH_THREADS', os.cpu_count())))
+
+
+def read_auth_body():
+    """
+    This function reads the JSON body of an /auth/register or /auth/login request.
+
+    It checks the size of the body (from the Content-Length header) before reading or parsing it,
+    so an oversized body is rejected without any parsing work.
+    It returns a tuple of (data, error_response): data is the parsed JSON object, or None with an error response to return.
+    """
+
+    # No Content-Length header (e.g. a chunked body) means we can't check the size up front, so require one
+    if request.content_length is None:
+        return None, ({"message": "Content-Length header required"}, 411)
+    if request.content_length > AUTH_MAX_CONTENT_LENGTH:
+        return None, ({"message": f"Request body must be at most {AUTH_MAX_CONTENT_LENGTH} bytes"}, 413)
+
+    # Parse the request body; `silent=True` gives None (instead of an error) if it isn't valid JSON,
+    # and `cache=False` means the parsed body isn't kept around on the request as well
+    data = request.get_json(silent=True, cache=False)
+    if not isinstance(data, dict):
+        return None, ({"message": "Request body must be a JSON object"}, 400)
+    return data, None
+
+
+# Recent failed login attempts (a hash of the username/email + password that was tried), remembered for 60 seconds.
+# If exactly the same wrong attempt is repeated, it's rejected straight away instead of running the slow password hash again.
+# Only failures are stored; caching successful logins would let a password keep working after it's changed.
+FAILED_LOGINS = TTLCache(maxsize=10000, ttl=60)
+FAILED_LOGINS_LOCK = threading.Lock() # TTLCache isn't thread safe on its own
+
+
+def verify_password(password_hash, password):
+    """
+    This function checks a plain text password against a stored password hash.
+
+    Users registered before the switch to Argon2 still have bcrypt hashes (these start with "$2"),
+    so those are checked with bcrypt. Everything else is checked with the Argon2 password hasher.
+    It returns True if the password matches, otherwise False.
+    """
+
+    # Old bcrypt hash
+    if password_hash.startswith("$2"):
+        return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+
+    # Argon2 hash; `verify()` raises an exception instead of returning False when the password doesn't match
+    try:
+        return ph.verify(password_hash, password)
+    except VerifyMismatchError:
+        return False
+
+# Query counting (development only). Counts the SQL queries run during each request and logs a warning when a request
+# runs more than QUERY_COUNT_WARN_THRESHOLD of them, which usually means an N+1 problem (one extra query per row,
+# e.g. from lazy-loading a relationship in a loop). Relationships should be declared with `lazy='selectin'` so
+# related rows are loaded in one `WHERE id IN (...)` query instead.
+QUERY_COUNT_WARN_THRESHOLD = 10
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    # This runs before every SQL statement; only count it if we're inside a request
+    if app.debug and has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.teardown_request
+def warn_on_many_queries(exc):
+    # This runs at the very end of every request; warn if the request ran too many queries.
+    # (Not `after_request`: that runs before a streamed body like `GET /products` is generated, so the queries
+    # run while streaming wouldn't be counted. With `stream_with_context()` teardown waits until the stream is done)
+    if app.debug and g.get('query_count', 0) > QUERY_COUNT_WARN_THRESHOLD:
+        app.logger.warning("%s %s ran %d SQL queries", request.method, request.path, g.query_count)
+
 # Define a User model that will be used to store user data in the database.
 # The model is defined as a class that inherits from the `db.Model` class provided by Flask-SQLAlchemy.
 class User (db.Model):
@@ -46,34 +192,92 @@ class User (db.Model):
     # The `is_admin` column is a boolean column that will store whether each user is an admin or not. It defaults to False.
     is_admin = db.Column(db.Boolean, default=False)
 
-# Define a schema for the User class that will be used to serialize and deserialize User objects.
+# Define a schema for the User class that will be used to serialize User objects in responses.
 # The schema is defined as a class that inherits from the `ma.Schema` class provided by Flask-Marshmallow.
-class UserSchema(ma.Schema):
+# It is the public view of a user, so the password is simply left out of its fields (rather than listing it and
+# then excluding it with `exclude=['password']`, which Marshmallow has to filter out for every schema instance).
+class UserPublicSchema(ma.Schema):
     # The `Meta` class inside the schema is used to specify additional metadata about the schema.
-    # In this case, we specify the fields that should be included in the serialized and deserialized output.
-    # The `fields` attribute is a tuple that lists the names of the fields that should be included.
+    # In this case, we specify the fields that should be included in the serialized output.
     class Meta:
         # The `fields` attribute is a tuple that lists the names of the fields that should be included.
-        # In this case, we include the `id`, `username`, `email`, `password`, and `is_admin` fields.
-        fields = ('id', 'username', 'email', 'password', 'is_admin')
+        # In this case, we include the `id`, `username`, `email`, and `is_admin` fields (never the password).
+        fields = ('id', 'username', 'email', 'is_admin')
 
-user_schema = UserSchema(exclude=['password'])
-users_schema = UserSchema(many=True, exclude=['password']) 
+user_schema = UserPublicSchema()
+users_schema = UserPublicSchema(many=True) 
 
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    # Price is stored as a whole number of cents (e.g. 1599 for $15.99), so there's no floating point rounding error.
+    # The API still sends and receives prices in dollars; the pydantic models below convert between the two
+    price = db.Column(db.Integer, nullable=False)
     description = db.Column(db.Text, nullable=True)
     stock = db.Column(db.Integer)
-
-class ProductSchema(ma.Schema):
-    class Meta:
-        fields = ('id', 'name', 'price', 'description', 'stock')
-
-product_schema = ProductSchema()
-products_schema = ProductSchema(many=True)
+    # Version number of the product; starts at 1 and goes up by 1 every time the product is updated. Used for the ETag headers
+    # (a timestamp isn't reliable for this: two updates can happen within the same clock tick or the same transaction time)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+# Products are validated and serialized with pydantic models instead of a Marshmallow schema.
+# Pydantic's validation and serialization run in compiled Rust code (pydantic-core), which is much faster than
+# Marshmallow looking up and checking each field in Python.
+
+def dollars_to_cents(price):
+    # Convert a price in dollars (as sent by the client) to whole cents for the database, e.g. 15.99 -> 1599
+    return None if price is None else round(price * 100)
+
+# The data needed to create a product (checked when a product is created)
+class ProductIn(BaseModel):
+    name: str
+    price: float
+    description: Optional[str] = None
+    stock: int
+
+    # After validation, `price` holds cents (ready to save), not dollars
+    @field_validator('price')
+    @classmethod
+    def price_to_cents(cls, price):
+        return dollars_to_cents(price)
+
+# The data that can be changed on a product; every field is optional (checked when a product is updated)
+class ProductUpdate(BaseModel):
+    name: Optional[str] = None
+    price: Optional[float] = None
+    description: Optional[str] = None
+    stock: Optional[int] = None
+
+    # After validation, `price` holds cents (ready to save), not dollars
+    @field_validator('price')
+    @classmethod
+    def price_to_cents(cls, price):
+        return dollars_to_cents(price)
+
+# The product data sent back in responses; `from_attributes=True` lets it read the fields straight off a `Product` object
+class ProductOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: str
+    price: float
+    description: Optional[str] = None
+    stock: Optional[int] = None
+
+    # The database stores cents; send dollars back to the client
+    @field_validator('price', mode='before')
+    @classmethod
+    def cents_to_dollars(cls, price):
+        return price / 100
+
+def product_response(product, status=200):
+    # Serialize a `Product` to JSON with pydantic and wrap it in a response
+    return app.response_class(ProductOut.model_validate(product).model_dump_json(), status=status, mimetype='application/json')
+
+@app.errorhandler(ValidationError)
+def handle_validation_error(e):
+    # If the request body doesn't match the pydantic model, return a 400 Bad Request response listing what was wrong
+    return {"message": "Invalid product data", "errors": e.errors(include_url=False, include_context=False)}, 400
 
 
 
@@ -106,8 +310,7 @@ def seed_db():
 
     This function does the following:
     - Prints a message to indicate that the database is being seeded.
-    - Creates two instances of the Product model, each with a name, description, price, and stock value.
-    - Adds the instances to the database session.
+    - Inserts two products, each with a name, description, price, and stock value, in a single bulk INSERT.
     - Commits the changes to the database.
     - Prints a message to indicate that the database has been seeded.
     """
@@ -115,27 +318,13 @@ def seed_db():
     # Print a message to indicate that the database is being seeded
     print("Seeding database")
 
-    # Create an instance of the Product model with a name, description, price, and stock value
-    product1 = Product(
-        name="Fruit",  # The name of the product
-        description="Fresh fruit",  # The description of the product
-        price=15.99,  # The price of the product
-        stock=100  # The stock of the product
-    )
-
-    # Create another instance of the Product model with a name, description, price, and stock value
-    product2 = Product(
-        name="Vegetable",  # The name of the product
-        description="Fresh vegetable",  # The description of the product
-        price=10.99,  # The price of the product
-        stock=100  # The stock of the product
-    )
-
-    # Create a list of the two instances
-    products = [product1, product2]
-
-    # Add the instances to the database session
-    db.session.add_all(products)
+    # Insert all the products with one Core `insert()` statement and a list of rows (one dictionary per product)
+    # This skips creating a Product object for each row and sends them to the database together,
+    # so it stays fast however many products are seeded
+    db.session.execute(db.insert(Product), [
+        {"name": "Fruit", "description": "Fresh fruit", "price": 1599, "stock": 100}, # price in cents, i.e. $15.99
+        {"name": "Vegetable", "description": "Fresh vegetable", "price": 1099, "stock": 100}, # price in cents, i.e. $10.99
+    ])
 
     # Commit the changes to the database
     db.session.commit()
@@ -157,106 +346,149 @@ def drop_db():  # This function is the command-line interface (CLI) command
     # This message is printed after the `db.drop_all()` function is called to indicate that the tables have been successfully dropped
     print("Tables dropped")
 
-@app.route("/products")
-def get_products():
-    stmt = db.select(Product)
-
-    products_list = db.session.scalars(stmt)
+# The last `GET /products` response as one `(etag, body)` tuple (only ever one entry; replaced when the ETag changes).
+# Storing both together means a request can never read the ETag of one version with the body of another
+products_response_cache = {'latest': (None, None)}
 
-    data = products_schema.dump(products_list)
+def not_modified(etag):
+    # A 304 Not Modified response (no body) that still tells the client which version it has
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
 
-    return data
+@app.route("/products", provide_automatic_options=False)
+def get_products():
+    # Build an ETag (a fingerprint of the product list) from every product's `(id, version)` pair.
+    # Any insert or delete changes the set of IDs and any update changes that product's version, so every write changes the ETag.
+    # The fingerprint is worked out inside postgres (`md5(string_agg(id || ':' || version, ',' ORDER BY id))`),
+    # so only one short string comes back, instead of every row being sent over and hashed in Python on every request.
+    # `coalesce` gives an empty table an ETag too (string_agg of no rows is NULL)
+    pairs = db.func.string_agg(
+        db.func.concat(Product.id, ':', Product.version),
+        aggregate_order_by(db.literal_column("','"), Product.id),
+    )
+    etag = db.session.scalar(db.select(db.func.md5(db.func.coalesce(pairs, ''))))
+
+    # If the client already has this version (it sends the ETag back in the If-None-Match header), just tell it so
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    # If we've already built the response for this version, send the stored copy without touching the products table
+    cached_etag, cached_body = products_response_cache['latest']
+    if cached_etag == etag:
+        response = app.response_class(cached_body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    # Fetch the products from the database in batches of 1000 rather than loading the whole table at once
+    # `raiseload('*')` makes any accidental lazy-load of a relationship raise an error instead of quietly running one query per product
+    stmt = db.select(Product).options(raiseload('*')).execution_options(yield_per=1000)
+
+    # Build the JSON list piece by piece as the rows come in, using orjson (much faster than the standard json module).
+    # This skips Marshmallow, which has to look up every field of every product in Python.
+    # The pieces are also kept so the finished body can be stored for the next request
+    def generate():
+        chunks = [b'[']
+        yield chunks[-1]
+        for p in db.session.scalars(stmt):
+            if len(chunks) > 1:
+                chunks.append(b',')
+                yield chunks[-1]
+            chunks.append(orjson.dumps({'id': p.id, 'name': p.name, 'price': p.price / 100, 'description': p.description, 'stock': p.stock}))
+            yield chunks[-1]
+        chunks.append(b']')
+        yield chunks[-1]
+        products_response_cache['latest'] = (etag, b''.join(chunks))
+
+    # Stream the response; `stream_with_context()` keeps the request (and its database session) open while the generator runs
+    response = app.response_class(stream_with_context(generate()), mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 # Dynamic routing
-@app.route("/products/<int:product_id>")
+@app.route("/products/<int:product_id>", provide_automatic_options=False)
 def get_product(product_id):
     # This route defines a dynamic endpoint that returns a product based on its ID
     
     # The `product_id` parameter is an integer that represents the ID of the product we want to retrieve
     
-    # We use the Flask-SQLAlchemy `db` object to define a SQLAlchemy query that selects a product from the database
-    # The query filters the products table for a row with an ID that matches the `product_id` parameter
-    stmt = db.select(Product).filter_by(id=product_id)
-    
-    # We execute the query and retrieve the first result (if any) using the `scalar()` method
-    # The `scalar()` method returns a single result, or None if no result is found
-    product = db.session.scalar(stmt)
-    
-    # If a product is found, we serialize it to JSON using the `jsonify()` method of the `product_schema` object
-    # The `jsonify()` method converts a Python object to a JSON response
+    # We look the product up by its primary key using the `db.session.get()` method
+    # It checks the session's identity map first and only queries the database if needed; it returns None if no product is found
+    product = db.session.get(Product, product_id)
+
     # If no product is found, we return a JSON response with a message indicating that the product was not found
-    try:
-        return product_schema.dump(product)
-    except:
+    # (a plain `is None` check, rather than letting serialization fail and catching the exception)
+    if product is None:
         return {"message": "Product not found"}, 404
+
+    # Build an ETag from the product's ID and version
+    # If the client already has this version (sent back in the If-None-Match header), return 304 Not Modified with no body
+    etag = hashlib.md5(f"{product.id}:{product.version}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    # Otherwise we serialize the product to JSON using the `product_response()` function
+    response = product_response(product)
+    response.set_etag(etag)
+    return response
     
-@app.route("/products", methods=["POST"])
+@app.route("/products", methods=["POST"], provide_automatic_options=False)
 @jwt_required() # This line uses the Flask-JWT-Extended library to require a valid JWT (JSON Web Token) for this endpoint
 def create_product():
     # This function creates a new product in the database using data sent in a JSON payload in the request body.
-    # The function loads the data from the request body into a Python dictionary using the `product_schema.load()` method.
-    # This method ensures that the data in the request body is valid according to the schema defined in `product_schema`.
-    # The function then creates a new `Product` object using the data from the dictionary and saves it to the database using the `db.session.add()` method.
+    # The function validates the data from the request body using the `ProductIn.model_validate()` method.
+    # This method ensures that the data in the request body is valid according to the `ProductIn` model (a 400 response is returned if not).
+    # The function then creates a new `Product` object using the validated data and saves it to the database using the `db.session.add()` method.
     # The `db.session.commit()` method saves the changes to the database.
-    # After the product is saved to the database, the function retrieves all the products from the database using the `db.session.scalars()` method.
-    # The `products_schema.dump()` method serializes the products to JSON and returns them in the response body with a status code of 201 (Created).
+    # After the product is saved to the database, the function serializes just the new product using the `product_response()` function
+    # and returns it in the response body with a status code of 201 (Created).
     
-    # Load the data from the request body into a Python dictionary using the `product_schema.load()` method
-    data = product_schema.load(request.json)
+    # Validate the data from the request body using the `ProductIn` model
+    data = ProductIn.model_validate(request.json)
     
-    # Create a new `Product` object using the data from the dictionary and save it to the database
+    # Create a new `Product` object using the validated data and save it to the database
     product = Product(
-        name = data["name"], # Set the name of the product
-        price = data["price"], # Set the price of the product
-        description = data["description"], # Set the description of the product
-        stock = data["stock"] # Set the stock of the product
+        name = data.name, # Set the name of the product
+        price = data.price, # Set the price of the product
+        description = data.description, # Set the description of the product
+        stock = data.stock # Set the stock of the product
     )
     db.session.add(product) # Add the product to the database session
     db.session.commit() # Save the changes to the database
     
-    # Retrieve all the products from the database
-    products = db.session.scalars(db.select(Product))
-    
-    # Serialize the products to JSON and return them in the response body with a status code of 201 (Created)
-    data = products_schema.dump(products)
-    
-    return data, 201 # Return the JSON response and the status code
+    # Serialize only the new product and return it in the response body with a status code of 201 (Created)
+    # (re-reading and dumping the whole products table on every write would get slower as the table grows)
+    return product_response(product, 201) # Return the JSON response and the status code
 
-@app.route("/products/<int:product_id>", methods=["PUT", "PATCH"])
+@app.route("/products/<int:product_id>", methods=["PUT", "PATCH"], provide_automatic_options=False)
 def update_product(product_id):
     # This route defines a dynamic endpoint that updates a product in the database based on its ID
     
-    # Define a SQLAlchemy query that selects a product from the database based on its ID
-    stmt = db.select(Product).filter_by(id=product_id)
-    
-    # Execute the query and retrieve the first result (if any) using the `scalar()` method
-    # The `scalar()` method returns a single result, or None if no result is found
-    product = db.session.scalar(stmt)
+    # Look the product up by its primary key using the `db.session.get()` method
+    # It returns the product, or None if no product is found
+    product = db.session.get(Product, product_id)
     
     # Check if a product was found
     if product:
-        # Load the data from the request body into a Python dictionary using the `product_schema.load()` method
-        # This method ensures that the data in the request body is valid according to the schema defined in `product_schema`
-        data = product_schema.load(request.json)
+        # Validate the data from the request body using the `ProductUpdate` model
+        # This ensures that the data in the request body is valid (every field is optional for an update)
+        data = ProductUpdate.model_validate(request.json)
         
-        # Update the product object with the new data from the request body
-        # If a field is not provided in the request body, keep the existing value
-        product.name = data["name"] or product.name # Set the name of the product
-        product.price = data["price"] or product.price # Set the price of the product
-        product.description = data["description"] or product.description # Set the description of the product
-        product.stock = data["stock"] or product.stock # Set the stock of the product
+        # Update the product object with only the fields that were sent in the request body (and aren't null)
+        # Fields that weren't sent keep their existing value, and only the changed columns end up in the SQL UPDATE
+        # (Unlike `data.price or product.price`, this also lets a price or stock be set to 0)
+        for field, value in data.model_dump(exclude_unset=True, exclude_none=True).items():
+            setattr(product, field, value)
+
+        # If anything actually changed, bump the version (done in SQL, so two concurrent updates both count)
+        if db.session.is_modified(product):
+            product.version = Product.version + 1
         
         # Save the changes to the database
         db.session.commit()
         
-        # Retrieve all the products from the database
-        products = db.session.scalars(db.select(Product))
-        
-        # Serialize the products to JSON
-        data = products_schema.dump(products)
-        
-        # Return the JSON response
-        return data
+        # Serialize only the updated product to JSON and return it
+        return product_response(product)
     else:
         # Return a JSON response indicating that the product was not found
         return {"message": "Product not found"}, 404
@@ -266,54 +498,42 @@ def auth_as_admin():
     This function checks if the user making the request is an admin.
     
     It does this by:
-    1. Getting the identity (i.e., the user's ID) from the JWT token.
-    2. Fetching the user from the database using the identity obtained in step 1.
-    3. Checking if the user exists. If not, it returns False.
-    4. Checking if the user is an admin. If not, it returns False.
-    5. If the user is an admin, it returns True.
+    1. Reading the `is_admin` claim that was put into the JWT token at login, so no database query is needed.
+    2. For older tokens issued without that claim, falling back to fetching the user by primary key with `db.session.get()`.
+    3. Returning True only if the user is an admin, otherwise False.
+
+    Note: because the admin flag travels in the token, a change to a user's admin status only takes effect once they log in again
+    (tokens expire after 1 day).
     """
     
-    # Get the identity from the JWT token
+    # Get the claims from the JWT token
     # The JWT token (JSON Web Token) is a compact, URL-safe means of representing claims between two parties.
-    # In this case, the identity refers to the user's ID.
-    identity = get_jwt_identity()
-    
-    # Fetch the user from the database using the identity obtained in step 1
-    # The database query filters the users table for a row with an ID that matches the identity.
-    # The `first()` method retrieves the first result (if any) from the query result.
-    user = User.query.filter_by(id=identity).first()
+    claims = get_jwt()
+    if "is_admin" in claims:
+        return bool(claims["is_admin"])
     
-    # Check if the user exists
-    # If the user does not exist, return False
-    if not user:
-        return False
-    
-    # Check if the user is an admin
-    # If the user is not an admin, return False
-    if not user.is_admin:
-        return False
+    # Older token without the claim: fetch the user using the identity (the user's ID, stored as a string in the token)
+    user = db.session.get(User, int(get_jwt_identity()))
     
-    # If the user is an admin, return True
-    return True
+    # The user must exist and be an admin
+    return bool(user and user.is_admin)
     
 
 # This route is used to check if the user making the request is an admin.
 # It accepts GET requests and requires a valid JWT token to access the endpoint.
 # The route returns a string representation of a boolean value indicating
 # whether the user is an admin or not.
-@app.route("/is_admin")
+@app.route("/is_admin", provide_automatic_options=False)
 @jwt_required()  # This line uses the Flask-JWT-Extended library to require a valid JWT (JSON Web Token) for this endpoint
 def is_admin():
     # Call the auth_as_admin() function to check if the user making the request is an admin.
-    # The auth_as_admin() function retrieves the identity from the JWT token
-    # and fetches the user from the database using the identity.
-    # It then checks if the user exists and if the user is an admin.
+    # The auth_as_admin() function reads the is_admin claim from the JWT token (no database query needed).
     # If the user is an admin, the function returns True, otherwise it returns False.
     # The return value of the auth_as_admin() function is converted to a string using the str() function.
     # The string representation of the boolean value is then returned in the response body.
     return str(auth_as_admin())
 
-@app.route("/products/<int:product_id>", methods=["DELETE"])
+@app.route("/products/<int:product_id>", methods=["DELETE"], provide_automatic_options=False)
 @jwt_required()
 def delete_product(product_id):
     """
@@ -323,8 +543,7 @@ def delete_product(product_id):
     The route first checks if the user making the request is an admin.
     If the user is not an admin, it returns a 401 Unauthorized response.
     If the user is an admin, it proceeds to delete the product from the database.
-    It first constructs a SQLAlchemy query to fetch the product from the database using the product ID.
-    It then executes the query and retrieves the first result (if any) using the `scalar()` method.
+    It fetches the product by its primary key using the `db.session.get()` method.
     If a product is found, it deletes the product from the database session using the `delete()` method.
     It then commits the changes to the database using the `commit()` method.
     Finally, it returns a JSON response indicating that the product has been deleted.
@@ -336,11 +555,8 @@ def delete_product(product_id):
     if not auth_as_admin():
         return {"message": "Unauthorized"}, 401
 
-    # Construct a SQLAlchemy query to fetch the product from the database using the product ID
-    stmt = db.select(Product).filter_by(id=product_id)
-
-    # Execute the query and retrieve the first result (if any) using the `scalar()` method
-    product = db.session.scalar(stmt)
+    # Fetch the product by its primary key using the `db.session.get()` method (None if not found)
+    product = db.session.get(Product, product_id)
 
     # Check if a product was found
     if product:
@@ -356,7 +572,7 @@ def delete_product(product_id):
         # Return a JSON response indicating that the product was not found with a 404 Not Found status code
         return {"message": "Product not found"}, 404
 
-@app.route("/auth/register", methods=["POST"])
+@app.route("/auth/register", methods=["POST"], provide_automatic_options=False)
 def register():
     """
     This function handles the registration of a new user.
@@ -366,18 +582,24 @@ def register():
     - email: the desired email for the new user
     - password: the desired password for the new user
 
-    If any of the required fields is missing, it returns a 400 Bad Request response with an error message.
+    If the request body is over 4 KB it is rejected with a 413 response before being parsed (see `read_auth_body()`).
+    If the body isn't a JSON object, or any of the required fields is missing, it returns a 400 Bad Request response with an error message.
     If the password is less than 8 characters, it returns a 400 Bad Request response with an error message.
-    If a user with the same username or email already exists, it returns a 400 Bad Request response with an error message.
-    If the input is valid, it hashes the password using bcrypt and creates a new User object with the provided username, email, hashed password, and is_admin flag (defaulting to False if not provided).
+    If the input is valid, it hashes the password using Argon2 and creates a new User object with the provided username, email, hashed password, and is_admin flag (defaulting to False if not provided).
     It adds the new user to the database session and commits the changes.
+    If a user with the same username or email already exists, the database's unique constraints reject the insert
+    (this saves checking for each one with a separate query first) and it returns a 400 Bad Request response with an error message.
     It returns a JSON response with the newly created user object and a 201 Created status code.
     If any exception occurs during the registration process, it returns a JSON response with the error message and a 500 Internal Server Error status code.
     """
     
+    # Check and parse the request body (outside the `try` below, so its error responses aren't turned into a 500)
+    data, error = read_auth_body()
+    if error:
+        return error
+
     try:
         # Extract the username, email, and password from the request body
-        data = request.json
         username = data.get("username")
         email = data.get("email")
         password = data.get("password")
@@ -390,14 +612,8 @@ def register():
         if len(password) < 8:
             return {"message": "Password must be at least 8 characters"}, 400
 
-        # Check if a user with the same username or email already exists
-        if User.query.filter_by(username=username).first():
-            return {"message": "Username already exists"}, 400
-        if User.query.filter_by(email=email).first():
-            return {"message": "Email already exists"}, 400
-
-        # Hash the password using bcrypt
-        hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
+        # Hash the password using Argon2 (on the hashing thread pool)
+        hashed_password = EXEC.submit(ph.hash, password).result()
 
         # Create a new User object with the provided data
         user = User(
@@ -413,15 +629,26 @@ def register():
 
         # Return a JSON response with the newly created user object and a 201 Created status code
         return user_schema.jsonify(user), 201
+    except IntegrityError as e:
+        # The username or email is already taken; psycopg2 tells us the name of the unique constraint that failed
+        # (`users_username_key` or `users_email_key`). Don't search the error text, the email itself could contain "username"
+        db.session.rollback()
+        msg = "Username" if e.orig.diag.constraint_name == "users_username_key" else "Email"
+        return {"message": f"{msg} already exists"}, 400
+    except HTTPException:
+        # Let Flask handle HTTP errors (e.g. 413 Request Entity Too Large) with their proper status code
+        raise
     except Exception as e:
         # Return a JSON response with the error message and a 500 Internal Server Error status code if an exception occurs
         return {"message": str(e)}, 500
 
 
-@app.route("/auth/login", methods=["POST"])
+@app.route("/auth/login", methods=["POST"], provide_automatic_options=False)
 def login():
-    # Get the JSON data from the request body
-    data = request.json
+    # Check and parse the JSON data from the request body (see `read_auth_body()`)
+    data, error = read_auth_body()
+    if error:
+        return error
 
     # Extract the username, email, and password from the request body
     username = data.get("username")
@@ -438,25 +665,46 @@ def login():
         # If the password is missing, return an error message with a 400 status code
         return {"message": "Missing password"}, 400
 
-    # Attempt to find a user in the database with the provided username
-    user = User.query.filter_by(username=username).first()
-
-    # If no user was found with the provided username, attempt to find a user with the provided email
-    if not user:
-        user = User.query.filter_by(email=email).first()
+    # If this exact attempt failed in the last 60 seconds, reject it without checking the database or hashing again
+    # (only a SHA-256 hash of the attempt is kept, never the password itself).
+    # The three fields are hashed as a JSON list, not joined with ':', so ("a", "b:c", ...) and ("a:b", "c", ...) can't clash
+    attempt = hashlib.sha256(orjson.dumps([username, email, password])).digest()
+    with FAILED_LOGINS_LOCK:
+        if attempt in FAILED_LOGINS:
+            return {"message": "Invalid username or password"}, 401
+
+    # Find a user in the database with the provided username OR the provided email, in a single query
+    # (both columns are unique, so each has an index that PostgreSQL can use for this).
+    # If the username and email belong to different users, the username match comes first (as it always has)
+    user = db.session.scalar(
+        db.select(User)
+        .where(db.or_(User.username == username, User.email == email))
+        .order_by((User.username == username).desc())
+        .limit(1)
+    )
 
     # Check if a user was found
     if not user:
         # If no user was found, return an error message with a 401 status code
         return {"message": "Invalid username or password"}, 401
 
-    # Check if the provided password matches the hashed password stored in the database
-    if not bcrypt.check_password_hash(user.password, password):
+    # Check if the provided password matches the hashed password stored in the database (on the hashing thread pool)
+    if not EXEC.submit(verify_password, user.password, password).result():
+        # Remember the failed attempt so an exact repeat is rejected quickly
+        with FAILED_LOGINS_LOCK:
+            FAILED_LOGINS[attempt] = True
         # If the provided password does not match the hashed password, return an error message with a 401 status code
         return {"message": "Invalid username or password"}, 401
+
+    # If the stored hash is an old bcrypt hash, or was made with different Argon2 settings, re-hash the password now
+    # (we have the plain text password at this point) and save the new hash
+    if user.password.startswith("$2") or ph.check_needs_rehash(user.password):
+        user.password = EXEC.submit(ph.hash, password).result()
+        db.session.commit()
     
     # Generate a JWT token with the user's ID as the identity and a 1-day expiration
-    token = create_access_token(identity=str(user.id), expires_delta=timedelta(days=1))
+    # The is_admin flag is added as an extra claim, so admin checks can read it from the token instead of the database
+    token = create_access_token(identity=str(user.id), additional_claims={"is_admin": user.is_admin}, expires_delta=timedelta(days=1))
 
     # Create a response object with the token, user email, and is_admin flag as JSON data
     response = make_response({"token": token, "email": user.email, "is_admin": user.is_admin}, 200)
@@ -0,0 +1,25 @@
+# Run with: gunicorn app:app
+# (Flask-SQLAlchemy and psycopg2 are synchronous, so instead of an async server we use threads:
+# while one thread waits on postgres, the others keep serving requests.)
+import os
+
+bind = os.getenv("BIND", "127.0.0.1:8080")
+
+# How many postgres connections all the workers together may use. Postgres allows 100 by default (max_connections),
+# so 80 leaves room for psql, migrations, etc. Raise it if max_connections is raised:
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", 80))
+
+# One worker process per core:
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count()))
+
+# Each worker runs several threads and has its own db connection pool with one connection per thread,
+# so workers x threads = the connection budget (e.g. 4 cores: 4 workers x 20 threads = 80 connections):
+worker_class = "gthread"
+threads = max(1, DB_CONNECTION_BUDGET // workers)
+
+# Passed on to app.py / config.py in each worker: the pool size to match the threads, and the number of
+# password hashing threads (about one per core across all the workers, as each hash uses 64 MiB):
+raw_env = [
+    f"DB_POOL_SIZE={threads}",
+    f"HASH_THREADS={max(1, os.cpu_count() // workers)}",
+]
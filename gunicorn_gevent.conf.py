@@ -0,0 +1,32 @@
+# Run with: gunicorn -c gunicorn_gevent.conf.py ethan_app_comments:app
+# gevent workers handle many requests at once per worker: while one request waits on postgres,
+# the worker switches to another. (The gevent worker monkey-patches the standard library itself.)
+import os
+
+bind = os.getenv("BIND", "127.0.0.1:8080")
+
+# How many postgres connections all the workers together may use. Postgres allows 100 by default (max_connections),
+# so 80 leaves room for psql, migrations, etc. Raise it if max_connections is raised:
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", 80))
+
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() * 2) + 1))
+worker_class = "gevent"
+
+# Each worker's share of the budget (e.g. 4 cores: 9 workers x 8 connections = 72). A request keeps its db connection
+# until it finishes, so a worker takes at most that many requests at once; more would just queue for a connection
+# inside the worker and time out (after 30 seconds) under load, instead of waiting in gunicorn's backlog:
+DB_POOL_SIZE = max(1, DB_CONNECTION_BUDGET // workers)
+worker_connections = DB_POOL_SIZE
+
+# Passed on to ethan_app_comments.py in each worker: the connection pool size, and the number of
+# password hashing threads (about one per core across all the workers, as each hash uses 64 MiB):
+raw_env = [
+    f"DB_POOL_SIZE={DB_POOL_SIZE}",
+    f"HASH_THREADS={max(1, os.cpu_count() // workers)}",
+]
+
+
+# psycopg2 is a C library, so gevent's patching doesn't reach it; psycogreen makes its waits yield to other requests too:
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()